@@ -9,16 +9,68 @@
 import zipfile
 import sys, os, re
 import plistlib
+import base64, datetime
+import io, functools, contextlib
+import mmap, struct, zlib
+import xml.parsers.expat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # default format string with property list tokens
 FORMAT  = '%CFBundleName|CFBundleDisplayName-v%CFBundleVersion-ios%MinimumOSVersion'
 
+# %token in format string, alternatives separated by |
+TOKEN = re.compile('%[A-Z][|a-zA-Z]+')
+
+# filesystem unsafe chars in generated filename replaced by space replacement
+UNSAFE = ' /:'
+SANITIZE = str.maketrans(dict.fromkeys(UNSAFE, '_'))
+
 # major properties recommended for format string
 MAJOR = 'MinimumOSVersion DTPlatformVersion CFBundleVersion CFBundleDisplayName CFBundleName'
 
 # information property list inside .ipa file
 INFO = '/Info.plist'
 
+# app bundle directory inside .ipa file
+PAYLOAD = 'Payload/'
+
+# app bundle extension
+APP = '.app'
+
+# read buffer size for ipa files
+BUFSIZE = 1 << 20
+
+# cmd line options: flag -> (option name, value), value None is taken from next parameter
+FLAGS = {
+    '-n':      ('dry', True),       # dry run
+    '-c':      ('crc', True),       # full archive crc check
+    '-t':      ('threads', True),   # threads for network storage
+    '-f':      ('frm', None),       # format string
+    '-format': ('frm', None),
+    '-k':      ('key', None),       # just show key(s): key, 'k1 k2 k3', all, major
+    '-key':    ('key', None)
+}
+
+# worker threads for ipa files on network storage (-t)
+THREADS = 8
+
+# zip end of central directory record, central directory and local file header
+EOCD_SIG, EOCD = b'PK\x05\x06', struct.Struct('<4s4H2LH')
+CDIR_SIG, CDIR = b'PK\x01\x02', struct.Struct('<4s6H3L5H2L')
+LOCAL_SIG, LOCAL = b'PK\x03\x04', struct.Struct('<4s5H3L2H')
+
+# binary plist trailer: offset size, ref size, object count, top object, offset table offset
+BPLIST_TRAILER = struct.Struct('>6xBBQQQ')
+
+# scalar plist value types extracted by targeted parser
+PLIST_SCALAR = {
+    'string':  str,
+    'integer': lambda text: int(text, 16) if text.startswith(('0x', '0X')) else int(text),
+    'real':    float,
+    'true':    lambda text: True,
+    'false':   lambda text: False
+}
+
 # version
 _version_ = '2018.4.1'
 
@@ -26,9 +78,11 @@ _version_ = '2018.4.1'
 _usage_ = """
 = IPA rename = normalize ipa filename = version {} =
 
-> {} [-n] [-k key] [-f 'format'] src.ipa
+> {} [-n] [-c] [-t] [-k key] [-f 'format'] src.ipa
 
  -n           ... dry-run, do not rename anything, just show what would be done
+ -c           ... check crc of all files in ipa archive (slow), default checks Info.plist only
+ -t           ... read files in threads instead of processes, faster for files on network storage (NAS)
  -k key       ... do not rename, just display specific key matched as case-sensitive substring
  -k all       ... do not rename, just display complete list of properties
  -k major     ... do not rename, just display list of major properties
@@ -60,140 +114,429 @@ ERR = {
     3: 'ERR: {} not found',
     4: 'ERR: not valid IPA file:{}',
     5: 'ERR: {} returns empty property list',
-    6: 'ERR: {}'
+    6: 'ERR: {}',
+    7: 'ERR: unknown option {}',
+    8: 'ERR: option {} requires value'
 }
 
 def usage(argc=1):
     """ show usage help and exit if argc is less than required count """
     if len(sys.argv) > argc: return
     S0 = sys.argv[0]
-    print(_usage_.format(_version_, S0, FORMAT, S0, S0, S0, S0))
+    print(_usage_.format(_version_, S0, FORMAT, S0, S0, S0, S0, S0))
     sys.exit(1)
 
-def error(code, par=''):
-    """ print message ERR[exitcode] """
-    # print(ERR.get(code,'').format(par), file=sys.stderr)
-    print(ERR.get(code,'').format(par))
-
-
-def ipa_readplist(ipa, plist):
-    """ read plist from ipa/zip file and handle errors """
+def errmsg(code, par=''):
+    """ message ERR[exitcode] """
+    return ERR.get(code,'').format(par)
+
+def error(code, par='', file=None):
+    """ print message ERR[exitcode] to file (default stdout) """
+    # print(errmsg(code, par), file=sys.stderr)
+    print(errmsg(code, par), file=file)
+
+
+def is_app_plist(name, plist):
+    """ name is app plist Payload/<App>.app/Info.plist (not plist of framework, extension, ...) """
+    return name.startswith(PAYLOAD) and name.endswith(APP + plist) and name.count('/') == 2
+
+class _Unsupported(Exception):
+    """ zip feature not supported by mmap_member - fall back to ZipFile """
+
+def mmap_member(ipa, match):
+    """ read first member matching match(name) directly from mmap-ed zip file, bypassing ZipFile,
+        returns decompressed data or None if not found, raises _Unsupported for unsupported
+        zip features (zip64, encryption, compression method) """
+    with open(ipa, 'rb') as fh:
+        try:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file can not be mapped
+            raise zipfile.BadZipFile(ipa)
+    with mm:
+        try:
+            # end of central directory record (followed by optional comment up to 64k)
+            eocd = mm.rfind(EOCD_SIG, max(0, len(mm) - EOCD.size - 0xFFFF))
+            if eocd < 0:
+                raise zipfile.BadZipFile(ipa)
+            _, _, _, _, entries, cd_size, cd_offset, _ = EOCD.unpack_from(mm, eocd)
+            if entries == 0xFFFF or cd_offset == 0xFFFFFFFF:
+                raise _Unsupported('zip64')
+            # data prepended to zip archive shifts all offsets
+            concat = eocd - cd_size - cd_offset
+            off = cd_offset + concat
+            for _ in range(entries):
+                (sig, _, _, flags, method, _, _, crc, csize, usize,
+                 nlen, elen, clen, _, _, _, local) = CDIR.unpack_from(mm, off)
+                if sig != CDIR_SIG:
+                    raise zipfile.BadZipFile(ipa)
+                name = mm[off + CDIR.size:off + CDIR.size + nlen].decode('utf-8' if flags & 0x800 else 'cp437')
+                off += CDIR.size + nlen + elen + clen
+                if not match(name):
+                    continue
+                if flags & 0x1:
+                    raise _Unsupported('encrypted')
+                if 0xFFFFFFFF in (csize, usize, local):
+                    raise _Unsupported('zip64')
+                # local file header has its own name and extra field lengths
+                local += concat
+                sig, *_, lnlen, lelen = LOCAL.unpack_from(mm, local)
+                if sig != LOCAL_SIG:
+                    raise zipfile.BadZipFile(ipa)
+                start = local + LOCAL.size + lnlen + lelen
+                if method == zipfile.ZIP_DEFLATED:
+                    data = zlib.decompress(mm[start:start + csize], -15)
+                elif method == zipfile.ZIP_STORED:
+                    data = mm[start:start + csize]
+                else:
+                    raise _Unsupported('compression method {}'.format(method))
+                if len(data) != usize or zlib.crc32(data) != crc:
+                    raise zipfile.BadZipFile(ipa)
+                return data
+        except (struct.error, zlib.error):
+            raise zipfile.BadZipFile(ipa)
+    return None
+
+def ipa_readplist(ipa, plist, verify=False, file=None, keys=None, raw=False):
+    """ read plist (only keys if specified) from ipa/zip file and handle errors,
+        raw reads plist directly from mmap-ed file (falls back to ZipFile if not supported) """
     root = None
     try:
-        with zipfile.ZipFile(ipa, 'r') as zip:
-            # validate crc/headers in zip file
-            err = zip.testzip()
-            if err:
-                error(2, err)
-                return
-            # parse zip
-            for zinfo in zip.infolist():
-                #print("zip: {}".format(zinfo.filename))
-                # look for plist filename
-                if zinfo.filename.endswith(plist):
-                    data = zip.read(zinfo)
-                    break
+        if raw:
+            try:
+                data = mmap_member(ipa, lambda n: is_app_plist(n, plist))
+            except _Unsupported:
+                pass
             else:
-                error(3, INFO)
+                if data is None:
+                    error(3, INFO, file)
+                    return
+                # peekable file object for plist_load
+                return plist_load(io.BufferedReader(io.BytesIO(data)), keys)
+        # large read buffer - fewer syscalls / network requests for zip headers
+        with open(ipa, 'rb', buffering=BUFSIZE) as fh, zipfile.ZipFile(fh, 'r') as zip:
+            # validate crc/headers of all members in zip file (slow, decompresses everything)
+            # crc of plist member itself is always validated by zipfile on read
+            if verify:
+                err = zip.testzip()
+                if err:
+                    error(2, err, file)
+                    return
+            # look for app plist in names from central directory
+            name = next((n for n in zip.namelist() if is_app_plist(n, plist)), None)
+            if name is None:
+                error(3, INFO, file)
                 return
-            # load property list
-            root = plistlib.loads(data)
+            zinfo = zip.getinfo(name)
+            # load property list streamed from decompressor
+            with zip.open(zinfo) as fp:
+                data = plist_load(fp, keys)
+                # targeted parser may stop early - read to EOF so zipfile validates plist crc
+                while fp.read(BUFSIZE):
+                    pass
+            # valid crc - use parsed plist
+            root = data
     except OSError as e:
-        error(6, '{}: {}'.format(e.strerror, e.filename))
+        error(6, '{}: {}'.format(e.strerror, e.filename), file)
     except zipfile.BadZipFile:
-        error(4, ipa)
+        error(4, ipa, file)
     return root
 
-def print_plist(plist, match='all', sep=' '):
-    """ print plist keys matching substring match """
+def _lxml_value(el):
+    """ convert lxml plist element to python value """
+    tag = el.tag
+    if tag == 'string':
+        return el.text or ''
+    if tag == 'integer':
+        return PLIST_SCALAR['integer'](el.text)
+    if tag == 'real':
+        return float(el.text)
+    if tag == 'true':
+        return True
+    if tag == 'false':
+        return False
+    if tag == 'date':
+        return datetime.datetime.strptime(el.text, '%Y-%m-%dT%H:%M:%SZ')
+    if tag == 'data':
+        return base64.b64decode(el.text or '')
+    # skip comments and processing instructions (non-string tags)
+    children = [c for c in el if isinstance(c.tag, str)]
+    if tag == 'array':
+        return [_lxml_value(c) for c in children]
+    if tag == 'dict':
+        return {k.text or '': _lxml_value(v) for k, v in zip(children[::2], children[1::2])}
+    raise ValueError('unsupported plist element: {}'.format(tag))
+
+def _load_lxml(fp, etree):
+    """ parse xml plist from binary file object with lxml, encoding is handled by xml parser """
+    root = etree.parse(fp, etree.XMLParser(resolve_entities=False, no_network=True)).getroot()
+    # <plist> wraps single top level element
+    for el in root:
+        if isinstance(el.tag, str):
+            return _lxml_value(el)
+
+class _KeysFound(Exception):
+    """ all wanted keys extracted - stop xml parsing """
+
+def extract_keys(fp, keys):
+    """ extract top level scalar values of wanted keys from xml plist file object, stop parsing when all found """
+    found, text = {}, []
+    depth, key = 0, None
+
+    def start(tag, attrs):
+        nonlocal depth
+        depth += 1
+        # <plist><dict> children <key> and values are on level 3
+        if depth == 3:
+            text.clear()
+
+    def chars(data):
+        if depth == 3:
+            text.append(data)
+
+    def end(tag):
+        nonlocal depth, key
+        if depth == 3:
+            if tag == 'key':
+                key = ''.join(text)
+            else:
+                # containers and other types are skipped
+                if key in keys and tag in PLIST_SCALAR:
+                    found[key] = PLIST_SCALAR[tag](''.join(text))
+                    if len(found) == len(keys):
+                        raise _KeysFound
+                key = None
+        depth -= 1
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start
+    parser.CharacterDataHandler = chars
+    parser.EndElementHandler = end
+    try:
+        parser.ParseFile(fp)
+    except _KeysFound:
+        pass
+    return found
+
+def extract_keys_binary(data, keys):
+    """ extract top level scalar values of wanted keys from binary plist bytes, other objects are not decoded """
+
+    def ref_offset(ref):
+        """ object offset from offset table """
+        pos = table + ref * offset_size
+        return int.from_bytes(data[pos:pos + offset_size], 'big')
+
+    def count(pos, info):
+        """ object count and start of object data, count >= 15 is stored in following int object """
+        if info != 0xF:
+            return info, pos + 1
+        size = 1 << (data[pos + 1] & 0xF)
+        return int.from_bytes(data[pos + 2:pos + 2 + size], 'big'), pos + 2 + size
+
+    def scalar(ref):
+        """ decode scalar object, None for other types """
+        pos = ref_offset(ref)
+        marker = data[pos]
+        kind, info = marker >> 4, marker & 0xF
+        if marker == 0x08:
+            return False
+        if marker == 0x09:
+            return True
+        if kind == 0x1:
+            return int.from_bytes(data[pos + 1:pos + 1 + (1 << info)], 'big', signed=info >= 3)
+        if kind == 0x2:
+            return struct.unpack_from('>f' if info == 2 else '>d', data, pos + 1)[0]
+        if kind == 0x5:
+            n, start = count(pos, info)
+            return data[start:start + n].decode('ascii')
+        if kind == 0x6:
+            n, start = count(pos, info)
+            return data[start:start + 2 * n].decode('utf-16be')
+        return None
+
+    try:
+        offset_size, ref_size, _, top, table = BPLIST_TRAILER.unpack_from(data, len(data) - BPLIST_TRAILER.size)
+        found = {}
+        pos = ref_offset(top)
+        # top level object has to be dict
+        if data[pos] >> 4 != 0xD:
+            return found
+        n, start = count(pos, data[pos] & 0xF)
+        # n key refs followed by n value refs
+        refs = [int.from_bytes(data[i:i + ref_size], 'big') for i in range(start, start + 2 * n * ref_size, ref_size)]
+        for kref, vref in zip(refs[:n], refs[n:]):
+            k = scalar(kref)
+            if k in keys:
+                v = scalar(vref)
+                if v is not None:
+                    found[k] = v
+                    if len(found) == len(keys): break
+        return found
+    except (IndexError, ValueError, struct.error):
+        raise plistlib.InvalidFileException()
+
+def plist_load(fp, keys=None):
+    """ parse property list from binary file object, only keys if specified,
+        use lxml for complete xml plist if available """
+    # peek does not consume data from buffered/zip file object
+    if fp.peek(8).startswith(b'bplist'):
+        # binary plist parser seeks to trailer and objects - backward seek in zip member restarts decompression
+        data = fp.read()
+        if keys:
+            return extract_keys_binary(data, keys)
+        return plistlib.loads(data)
+    if keys:
+        return extract_keys(fp, keys)
+    # optional lxml - faster complete plist parsing in libxml2 C code, imported only when needed
+    try:
+        from lxml import etree
+    except ImportError:
+        return plistlib.load(fp)
+    return _load_lxml(fp, etree)
+
+def print_plist(plist, match='all', sep=' ', file=None):
+    """ print plist keys matching substring match to file (default stdout) """
     # multiple match - match has multiple keys separated by separator sep
     if sep in match:
         for k in match.split(sep):
-            print("{}: {}".format(k, plist.get(k, '')))
+            print("{}: {}".format(k, plist.get(k, '')), file=file)
         return
     # single match - do substring match
-    for k in plist:
+    for k, v in plist.items():
         if match == 'all' or match in k:
-            print("{}: {}".format(k, plist.get(k, '')))
+            print("{}: {}".format(k, v), file=file)
     return
 
+@functools.lru_cache(maxsize=8)
+def compile_format(format):
+    """ split format string into segments (literal, None) and (%token, alternatives) """
+    segments, pos = [], 0
+    for m in TOKEN.finditer(format):
+        if m.start() > pos:
+            segments.append((format[pos:m.start()], None))
+        token = m.group(0)
+        segments.append((token, tuple(token[1:].split('|'))))
+        pos = m.end()
+    if pos < len(format):
+        segments.append((format[pos:], None))
+    return tuple(segments)
+
+def resolve_token(alternatives, plist, empty=''):
+    """ value of %token from plist, first non-empty value for token with alternatives """
+    for subtoken in alternatives:
+        # try subtoken value
+        val = plist.get(subtoken, empty)
+        # break if value not empty
+        if val != empty: break
+    return str(val)
+
 def format_name(plist, format, empty='', space='_', ext='.ipa'):
     """ build new name based on format tokens """
-    # start with format string
-    name = format
-    # all %tokens
-    for token in re.findall('(%[A-Z][|a-zA-Z]+)', format):
-        # token with alternatives
-        if '|' in token:
-            # token with alternatives
-            for subtoken in token[1:].split('|'):
-                # try subtoken value
-                val = plist.get(subtoken, empty)
-                # break if value not empty
-                if val != empty: break
-        else:
-            val = plist.get(token[1:], empty)
-        # replce token with val
-        name = name.replace(token, val, 1)
-    # space replacement and adding an extension
-    return name.replace(' ', space) + ext
-
-
-# ======
-#  MAIN
-# ======
-
-# usage help if no args given
-usage()
-
-# init
-frm, key, dry = FORMAT, None, False
-
-# iterate cmd line parameters
-it = iter(sys.argv[1:])
-for par in it:
-
-    # dry run: -n
-    if par == '-n':
-        dry = True
-        continue
-
-    # format string: -format 'format string'
-    if par.startswith('-f'):
-        frm = next(it)
-        continue
-
-    # just show key(s): -key key or -key 'k1 k2 k3' or -key all
-    if par.startswith('-k'):
-        key = next(it)
-        continue
-
-    # filename
-    ipa = par
-    plist = ipa_readplist(ipa, INFO)
+    # join literals and %token values from compiled (cached) format
+    name = ''.join(text if alternatives is None else resolve_token(alternatives, plist, empty)
+                   for text, alternatives in compile_format(format))
+    # space (and unsafe chars) replacement in single pass and adding an extension
+    table = SANITIZE if space == '_' else str.maketrans(dict.fromkeys(UNSAFE, space))
+    return name.translate(table) + ext
+
+def process_ipa(ipa, frm=FORMAT, key=None, crc=False, dry=False):
+    """ process single ipa file (in worker), return (output text, src, dst) - rename src to dst is left to caller """
+    # per file output buffer, safe for both worker processes and threads
+    out = io.StringIO()
+    # known keys only for rename and major, complete plist otherwise
+    keys = None
+    if key is None:
+        keys = {k for _, alternatives in compile_format(frm) if alternatives for k in alternatives}
+    elif key == 'major':
+        keys = set(MAJOR.split())
+    # display only reads plist directly from mmap-ed file unless full archive check is requested
+    plist = ipa_readplist(ipa, INFO, crc, out, keys, raw=key is not None and not crc)
     if plist is None:
-        error(5, ipa)
-        continue
+        error(5, ipa, out)
+        return out.getvalue(), ipa, None
 
     # display major keys: -key major
     if key == 'major':
-        print_plist(plist, MAJOR)
-        continue
+        print_plist(plist, MAJOR, file=out)
+        return out.getvalue(), ipa, None
 
     # display key(s): -key *key* or -key all
     if key:
-        print_plist(plist, key)
-        continue
+        print_plist(plist, key, file=out)
+        return out.getvalue(), ipa, None
 
     # rename
-    newname = ipa.replace(os.path.basename(ipa), format_name(plist, frm))
+    dirname, _ = os.path.split(ipa)
+    newname = os.path.join(dirname, format_name(plist, frm))
     # verbose output
-    print("{} -> {}".format(ipa, newname), end=' ')
+    print("{} -> {}".format(ipa, newname), end=' ', file=out)
     if dry:
-        print()
-        continue
-    try:
-        os.rename(ipa, newname)
-        print('OK')
-    except OSError as e:
-        error(6, '{}: {}'.format(e.strerror, e.filename))
+        print(file=out)
+        return out.getvalue(), ipa, None
+    return out.getvalue(), ipa, newname
+
+def process_ipa_args(args):
+    """ process_ipa with packed args for executor map """
+    return process_ipa(*args)
+
+
+# ======
+#  MAIN
+# ======
+
+if __name__ == '__main__':
+
+    # usage help if no args given
+    usage()
+
+    # init
+    opt = {'frm': FORMAT, 'key': None, 'dry': False, 'crc': False, 'threads': False}
+
+    # per file jobs - options apply to files following them
+    jobs = []
+
+    # iterate cmd line parameters
+    it = iter(sys.argv[1:])
+    for par in it:
+
+        # option: exact match, value None is taken from next parameter
+        if par in FLAGS:
+            name, val = FLAGS[par]
+            if val is None:
+                val = next(it, None)
+                # missing value at the end of cmd line
+                if val is None:
+                    error(8, par)
+                    continue
+            opt[name] = val
+            continue
+
+        # unknown option
+        if par.startswith('-'):
+            error(7, par)
+            continue
+
+        # filename
+        jobs.append((par, opt['frm'], opt['key'], opt['crc'], opt['dry']))
+
+    # read ipa files in parallel, output and rename in submission order
+    # processes for cpu bound decompress and parse, threads to overlap network storage latency
+    # single file is processed inline - no worker startup cost
+    if len(jobs) <= 1:
+        executor = None
+    elif opt['threads']:
+        executor = ThreadPoolExecutor(max_workers=THREADS)
+    else:
+        executor = ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1))
+    with executor or contextlib.nullcontext():
+        results = executor.map(process_ipa_args, jobs) if executor else map(process_ipa_args, jobs)
+        for text, ipa, newname in results:
+            if newname is not None:
+                try:
+                    os.replace(ipa, newname)
+                    text += 'OK\n'
+                except OSError as e:
+                    text += errmsg(6, '{}: {}'.format(e.strerror, e.filename)) + '\n'
+            # single buffered write per file
+            sys.stdout.write(text)
+    sys.stdout.flush()